@@ -12,12 +12,15 @@
 ##############################################################################
 
 import numpy as np
-from scipy.interpolate import lagrange
+import pandas as pd
+from scipy.fft import rfft, irfft, next_fast_len
 from numba import njit, prange
 import sys
+import os
 
-@njit(parallel=True)
-def FilonLagrange(DFT,freq,Time,coeffs):
+# Compiled on first call and cached in __pycache__ for later runs
+@njit(parallel=True, fastmath=True, boundscheck=False, error_model='numpy', cache=True)
+def FilonLagrange(DFT,freq,Time,a,b,c):
     """
     ==========================================================================================
     Computes the Fourier-Laplace transform using the coefficients from Lagrange interpolation
@@ -31,8 +34,8 @@ def FilonLagrange(DFT,freq,Time,coeffs):
         Array of frequencies (rad/s)
     Time : float
         Array of time points (s)
-    coeffs : float
-        Coefficients from the Lagrange interpolation
+    a, b, c : float
+        Quadratic, linear and constant coefficients from the Lagrange interpolation
 
     Returns
     -------
@@ -40,33 +43,160 @@ def FilonLagrange(DFT,freq,Time,coeffs):
         Array result of the Fourier-Laplace transform
 
     """
+    T1= Time[0:-2:2] #Segment-only quantities, shared by all frequencies
+    T2= Time[2::2]
+    # Each segment term is W(t)*(ff*p'(t) + i*(ff^2*p(t) - 2*a)) at t2 minus the same at t1,
+    # with p(t) = (a*t + b)*t + c and p'(t) = 2*a*t + b in Horner form
+    D1= 2*a*T1 + b
+    D2= 2*a*T2 + b
+    Q1= (a*T1 + b)*T1 + c
+    Q2= (a*T2 + b)*T2 + c
+    nseg= (len(Time)-1)//2
+    dt2= Time[2] - Time[0] #Equally spaced time points
     for ifreq in prange(len(freq)):
-        ip= 0
-        for it in range(0,len(Time)-2,2): #Skip intermediate points
-            t1= Time[it]
-            t2= Time[it+2]
-            a= coeffs[ip,0]
-            b= coeffs[ip,1]
-            c= coeffs[ip,2]
-            ff= freq[ifreq]
-            DFT[ifreq] += (1/ff**3) * (np.exp(-1j*ff*t2) * (a * (ff * t2 * (2 + 1j * ff * t2) - 2 * 1j) 
-                             + ff * (1j * b * ff * t2 + b + 1j * c * ff)) - 
-                             1j * np.exp(-1j * ff * t1) * (a * (-2 + ff * t1 * (ff * t1 - 2*1j)) +
-                                                           ff * (c * ff + b * (ff * t1 - 1j))))
-            ip += 1
+        ff= freq[ifreq]
+        ff2= ff*ff
+        step= np.exp(-1j*ff*dt2)
+        e1= np.exp(-1j*ff*Time[0])
+        acc= 0j
+        for ip in range(nseg):
+            a2= 2*a[ip]
+            e2= e1 * step #exp(-i*ff*t2) by recurrence from exp(-i*ff*t1)
+            acc += (e2 * complex(ff * D2[ip], ff2 * Q2[ip] - a2) -
+                    e1 * complex(ff * D1[ip], ff2 * Q1[ip] - a2))
+            e1= e2
+        DFT[ifreq] += acc / (ff2*ff)
             
     return DFT
 
-def LagrangeInterpol(coeffs,Time,Signal):
+def FilonWeights(Time,a,b,c):
+    """
+    ==========================================================================================
+    Computes the frequency-independent weights of the Filon-Lagrange sum on segment endpoints
+    ==========================================================================================
+    
+    Parameters
+    ----------
+    Time : float
+        Array of time points (s)
+    a, b, c : float
+        Quadratic, linear and constant coefficients from the Lagrange interpolation
+
+    Returns
+    -------
+    V : float
+        Array (nseg+1, 3) of weights for the ff^0, ff^1 and ff^2 terms
+
+    """
+    T1= Time[0:-2:2]
+    T2= Time[2::2]
+    nseg= len(T1)
+    # Each segment contributes W(t2)*(-2i*a + ff*p'(t2) + i*ff^2*p(t2)) minus the same at t1,
+    # with p the interpolating parabola, so the sum splits into powers of ff times W @ V
+    V= np.zeros((nseg+1,3))
+    V[1:,0] += a
+    V[:-1,0] -= a
+    V[1:,1] += 2*a*T2 + b
+    V[:-1,1] -= 2*a*T1 + b
+    V[1:,2] += (a*T2 + b)*T2 + c
+    V[:-1,2] -= (a*T1 + b)*T1 + c
+
+    return V
+
+def FilonLagrangeVec(freq,Time,a,b,c,block=512):
+    """
+    ==========================================================================================
+    Computes the Fourier-Laplace transform using the coefficients from Lagrange interpolation,
+    as a complex matrix product between the phase factors and the segment polynomials
+    ==========================================================================================
+    
+    Parameters
+    ----------
+    freq : float
+        Array of frequencies (rad/s)
+    Time : float
+        Array of time points (s)
+    a, b, c : float
+        Quadratic, linear and constant coefficients from the Lagrange interpolation
+    block : int
+        Number of segment endpoints per tile of phase factors
+
+    Returns
+    -------
+    DFT : complex
+        Array result of the Fourier-Laplace transform
+
+    """
+    V= FilonWeights(Time,a,b,c)
+    nseg= len(V)-1
+    Tn= Time[0:2*nseg+1:2] #Segment endpoints
+    step= np.exp(-1j*freq*(Time[2]-Time[0]))
+    M= np.zeros((len(freq),3),dtype=complex)
+    W= np.empty((len(freq),min(block,nseg+1)),dtype=complex)
+    for s0 in range(0,nseg+1,block): #Tiles of W stay in cache instead of a full (nfreq, nseg+1) table
+        nb= min(block,nseg+1-s0)
+        Wb= W[:,:nb]
+        Wb[:,0]= np.exp(-1j*freq*Tn[s0]) #exp(-i*ff*t) on the tile, by recurrence
+        Wb[:,1:]= step[:,None]
+        np.cumprod(Wb,axis=1,out=Wb)
+        M += Wb @ V[s0:s0+nb]
+    DFT= (-2j*M[:,0] + freq*M[:,1] + 1j*freq*freq*M[:,2]) / freq**3
+
+    return DFT
+
+def FilonLagrangeGPU(freq,Time,a,b,c,block=65536):
+    """
+    ==========================================================================================
+    Computes the Fourier-Laplace transform using the coefficients from Lagrange interpolation,
+    as matrix products on the GPU with CuPy
+    ==========================================================================================
+    
+    Parameters
+    ----------
+    freq : float
+        Array of frequencies (rad/s)
+    Time : float
+        Array of time points (s)
+    a, b, c : float
+        Quadratic, linear and constant coefficients from the Lagrange interpolation
+    block : int
+        Number of segment endpoints per tile of phase factors
+
+    Returns
+    -------
+    DFT : complex
+        Array result of the Fourier-Laplace transform
+
+    """
+    import cupy as cp
+
+    V= FilonWeights(Time,a,b,c)
+    nseg= len(V)-1
+    # Double precision throughout: -2i*M0 + ff*M1 + i*ff^2*M2 cancels strongly at low ff
+    V_g= cp.asarray(V)
+    freq_g= cp.asarray(freq)
+    Tn_g= cp.asarray(Time[0:2*nseg+1:2]) #Segment endpoints
+    Mr= cp.zeros((len(freq),3))
+    Mi= cp.zeros((len(freq),3))
+    for s0 in range(0,nseg+1,block):
+        ph= cp.outer(freq_g,Tn_g[s0:s0+block])
+        Vb= V_g[s0:s0+block]
+        Mr += cp.cos(ph) @ Vb #exp(-i*ff*t) @ V as two real products
+        Mi -= cp.sin(ph) @ Vb
+    M= cp.asnumpy(Mr) + 1j*cp.asnumpy(Mi)
+    DFT= (-2j*M[:,0] + freq*M[:,1] + 1j*freq*freq*M[:,2]) / freq**3
+
+    return DFT
+
+def LagrangeInterpol(Time,Signal):
     """   
     ==========================================================================================
-    Computes the polynomial coefficients for the Lagrange interpolators
+    Computes the polynomial coefficients for the Lagrange interpolators, in closed form for
+    equally spaced triplets of time points
     ==========================================================================================
     
     Parameters
     ----------
-    coeffs : float
-        Coefficients from the Lagrange interpolation
     Time : float
         Array of time points (s)
     Signal : float
@@ -74,21 +204,25 @@ def LagrangeInterpol(coeffs,Time,Signal):
 
     Returns
     -------
-    coeffs : float
-        Coefficients from the Lagrange interpolation
+    a, b, c : float
+        Quadratic, linear and constant coefficients from the Lagrange interpolation
 
     """
-    ipp= 0
-    for ip in prange(1,len(Time)-1,2):
-        x= Time[ip-1:ip+2]
-        y= Signal[ip-1:ip+2]
-        p= lagrange(x,y)   
-        coeffs[ipp,:] = p.coef
-        ipp += 1
-        
-    return np.array(coeffs)
+    Signal= np.asarray(Signal)
+    x0= Time[0:-2:2]
+    x1= Time[1:-1:2]
+    x2= Time[2::2]
+    y0= Signal[0:-2:2]
+    y1= Signal[1:-1:2]
+    y2= Signal[2::2]
+    h= Time[1] - Time[0] #Equally spaced time points
+    a= (y0 - 2*y1 + y2) / (2*h*h)
+    b= (y2 - y0) / (2*h) - a * (x0 + x2)
+    c= y1 - a * x1 * x1 - b * x1
+
+    return a, b, c
   
-def AdmFromQ(Time,QACF,freq):
+def AdmFromQ(Time,QACF,freq,beta,method='vec'):
     """
     ==========================================================================================
     Computes the admittance from the total charge autocorrelation function
@@ -102,6 +236,11 @@ def AdmFromQ(Time,QACF,freq):
         Total charge autocorrelation function
     freq : float
         Array of frequencies (rad/s)
+    beta : float
+        Inverse thermal energy 1/(k*T) (1/J)
+    method : str
+        Fourier-Laplace transform: 'vec' (NumPy/BLAS), 'numba' (per-frequency Numba kernel)
+        or 'gpu' (CuPy)
 
     Returns
     -------
@@ -109,15 +248,20 @@ def AdmFromQ(Time,QACF,freq):
         Admittance array (1/ohm)
 
     """
-    coeffs= np.zeros(((len(Time))//2,3))
-    Coeffs= LagrangeInterpol(coeffs,Time,QACF)
-    DFT= FilonLagrange(np.zeros(len(freq),dtype=complex),freq,Time,Coeffs)
-    Adm= np.zeros(len(DFT),dtype=complex)
-    for i in range(len(freq)):
-        Adm[i]= beta * ((freq[i]**2)*DFT[i] + 1j * freq[i] * QACF[0] )
+    a, b, c= LagrangeInterpol(Time,QACF)
+    if method == 'vec':
+        DFT= FilonLagrangeVec(freq,Time,a,b,c)
+    elif method == 'numba':
+        DFT= FilonLagrange(np.zeros(len(freq),dtype=complex),freq,Time,a,b,c)
+    elif method == 'gpu':
+        DFT= FilonLagrangeGPU(freq,Time,a,b,c)
+    else:
+        raise ValueError("Unknown method '%s', expected 'vec', 'numba' or 'gpu'" % method)
+    q0= QACF[0]
+    Adm= beta * (freq*freq*DFT + 1j * freq * q0)
     return Adm
 
-def WKACF(x,time):
+def WKACF(x,time,single=False):
     """
     ==========================================================================================
     Computes the autocorrelation function of a time series using the Wiener-Khinchin theorem
@@ -129,15 +273,26 @@ def WKACF(x,time):
         Signal
     time : float
         Array of time points (s)
+    single : bool
+        Computes the FFTs in single precision (faster, but see the README for the accuracy)
     """
-    Ctt = np.fft.fftn(x-np.mean(x))
-    CC = Ctt[:] * np.conjugate(Ctt[:])
-    CC[:] = np.fft.ifftn(CC[:])
-    ACF = (CC[:len(CC)//2]).real / len(CC)
+    n = len(x)
+    nfft = next_fast_len(2*n-1, real=True) #Zero-padding avoids circular wrap-around
+    xc = x - np.mean(x)
+    if single:
+        scale = np.max(np.abs(xc)) #Charges in C^2 underflow single precision
+        if scale == 0:
+            scale = 1.0
+        xc = (xc / scale).astype(np.float32)
+    else:
+        scale = 1.0
+    Ctt = rfft(xc, n=nfft, workers=-1)
+    CC = Ctt.real**2 + Ctt.imag**2
+    ACF = irfft(CC, n=nfft, workers=-1)[:n//2].astype(np.float64) * (scale*scale / n)
     time= time[:len(time)//2]
     return ACF, time
 
-def Window(ACF, time):
+def Window(ACF, time, ep, tau):
     '''
     =========================================================================
     Applies a window to the autocorrelation function as describe in reference
@@ -149,16 +304,20 @@ def Window(ACF, time):
         Araay of QACF points                                                                                                                                                                              
     time : float                                                                                                                                                                                          
         Array of reduced time points (s)                                                                                                                                                                                  
+    ep : float
+        Steepness of the window (1/s)
+    tau : float
+        Time at which the window is halved (s)
     Returns                                                                                                                                                                                               
     -------                                                                                                                                                                                               
     Windowed QACF : float                                                        
         Autocorrelation function                                                                                                                                                                          
     '''
-    ACF_window=[]
-    for i in range(len(time)):
-        W=(np.exp(-1*ep*tau)+1)/(np.exp(ep*(time[i]-tau))+1)
-        ACF_window.append(ACF[i]*W)
-    return ACF_window
+    ACF=np.asarray(ACF)
+    time=np.asarray(time)
+    W0=np.exp(-1*ep*tau)+1
+    W=W0/(np.exp(ep*(time-tau))+1)
+    return ACF*W
 
 
 print('Start')
@@ -177,40 +336,94 @@ beta= 1/(k*temperature)
 ep = 18.9e9
 tau = 0.5e-9
 
-# Load data
-Data= np.loadtxt('total_charges.out', skiprows=3)
+# Output format: binary .npy files, plus .out text files with --text
+text= '--text' in sys.argv[1:]
+
+# Charge autocorrelation FFTs in double precision, or single precision with --fft32
+single= '--fft32' in sys.argv[1:]
+
+# Fourier-Laplace transform: NumPy/BLAS by default, Numba kernel with --numba,
+# GPU with --gpu (requires CuPy, only worth it for large nfreq)
+if '--gpu' in sys.argv[1:]:
+    method= 'gpu'
+elif '--numba' in sys.argv[1:]:
+    method= 'numba'
+else:
+    method= 'vec'
+if method == 'gpu':
+    try:
+        import cupy
+    except ImportError as err:
+        sys.exit('--gpu requires CuPy (https://cupy.dev), which could not be imported: %s' % err)
+
+# QACF, reused from QACF.npz if it was computed with the same timeperstep and FFT precision
+# from the same charges file (same size and modification time, if the file is still present);
+# delete it to recompute
+cache= None
+if os.path.exists('QACF.npz'):
+    with np.load('QACF.npz') as f:
+        cache= dict(f)
+    if (not all(key in cache for key in ('time','qacf','timeperstep','single','src_size','src_mtime_ns')) or
+            cache['timeperstep'] != timeperstep or cache['single'] != single):
+        cache= None
+    elif os.path.exists('total_charges.out'):
+        st= os.stat('total_charges.out')
+        if cache['src_size'] != st.st_size or cache['src_mtime_ns'] != st.st_mtime_ns:
+            cache= None
+
+if cache is not None:
+    redTime= cache['time']
+    QACF= cache['qacf']
+
+    print('QACF loaded from QACF.npz')
+else:
+    # Load data
+    st= os.stat('total_charges.out')
+    Data= pd.read_csv('total_charges.out', skiprows=3, sep=r'\s+', header=None, comment='#',
+                      usecols=[0,1], dtype=np.float64).to_numpy() #Only the step and total charge columns
+    Data= Data[~np.isnan(Data[:,0]),1] #Indented comment lines are read as rows without a step
+
+    print('Data loaded')
+
+    # Convert in SI units
+    Charges= Data * e
+    Time= np.arange(len(Data),dtype=np.float64) * timeperstep
 
-print('Data loaded')
+    QACF, redTime = WKACF(Charges,Time,single)
 
-# Convert in SI units
-Charges= Data[:,1] * e
-Time= np.arange(0,len(Data),1) * timeperstep
+    np.savez('QACF.npz',time=redTime,qacf=QACF,timeperstep=timeperstep,single=single,
+             src_size=st.st_size,src_mtime_ns=st.st_mtime_ns)
 
-# QACF
-QACF, redTime = WKACF(Charges,Time)
+    print('QACF computed')
 
-np.savetxt('QACF.out',np.column_stack((redTime,QACF)),header='Time (s) / QACF (C^2)')
+if text:
+    np.savetxt('QACF.out',np.column_stack((redTime,QACF)),header='Time (s) / QACF (C^2)')
 
-QACF_window=Window(QACF,redTime)
+QACF_window=Window(QACF,redTime,ep,tau)
 
-np.savetxt('QACF_window.out',np.column_stack((redTime,QACF_window)),header='Time (s) / Windowed QACF (C^2)')
+np.save('QACF_window.npy',np.column_stack((redTime,QACF_window)))
+if text:
+    np.savetxt('QACF_window.out',np.column_stack((redTime,QACF_window)),header='Time (s) / Windowed QACF (C^2)')
 
-print('QACF computed') 
+print('QACF windowed')
 
 # List of frequencies
 hif= (2*np.pi)/(redTime[1]*3)
 lof= (2*np.pi)/redTime[-1]
-freq= np.logspace(np.log10(lof),np.log10(hif),nfreq)
+freq= np.geomspace(lof,hif,nfreq)
 
 # Admittance / Impedance
-Adm= AdmFromQ(redTime,QACF_window, freq)
+Adm= AdmFromQ(redTime,QACF_window, freq, beta, method)
 Imp= 1/Adm
 
 print('Admittance / Impedance computed')
 
-np.savetxt('Admittance.out',np.column_stack((freq,Adm.real,Adm.imag)),
-           header='Frequency (rad/s) / Re[Y] (1/Ohm) / Im[Y] (1/Ohm)')
-np.savetxt('Impedance.out',np.column_stack((freq,Imp.real,Imp.imag)),
-           header='Frequency (rad/s) / Re[Z] (Ohm) / Im[Z] (Ohm)')
+np.save('Admittance.npy',np.column_stack((freq,Adm.real,Adm.imag)))
+np.save('Impedance.npy',np.column_stack((freq,Imp.real,Imp.imag)))
+if text:
+    np.savetxt('Admittance.out',np.column_stack((freq,Adm.real,Adm.imag)),
+               header='Frequency (rad/s) / Re[Y] (1/Ohm) / Im[Y] (1/Ohm)')
+    np.savetxt('Impedance.out',np.column_stack((freq,Imp.real,Imp.imag)),
+               header='Frequency (rad/s) / Re[Z] (Ohm) / Im[Z] (Ohm)')
 
 print('Done.')